@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import duckdb
+import plotly.express as px
 import streamlit as st
 import polars as pl
 
@@ -13,6 +14,9 @@ import polars as pl
 CREDENTIALS_PATH = "creds/creds.json"
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 TIMEZONE = "Asia/Singapore"  # gmt + 8
+COVERAGE_PATH = "s3://smartdbucket/datalog/cis_smartd_tbl_iot_coverage"
+DELIVERY_TREND_DAYS = 7
+FLEET_LOOKBACK_DAYS = 30
 
 with open(Path(CREDENTIALS_PATH), "r") as file:
     creds = json.load(file)
@@ -100,9 +104,147 @@ def get_s3_datalog(hiveperiod: str, district: str, unitno: list, hour: tuple):
     return df
 
 
+@st.cache_data(ttl=600)
+def get_coverage(start_date, end_date, district: str):
+    # coverage table is maintained by the compacter, one small file per day
+    with init_duckdb_connection(aws_creds, "4GB") as conn:
+        df = conn.sql(
+            f"""
+            SELECT hiveperiod, dstrct_code, unitno, hour_wita, expected_seconds, received_seconds, gaps
+            FROM read_parquet('{COVERAGE_PATH}/**/*.parquet',hive_partitioning=true)
+            WHERE hiveperiod BETWEEN '{start_date}' AND '{end_date}'
+                AND dstrct_code = '{district}'
+            """
+        ).pl()
+
+    return df
+
+
+@st.cache_data(ttl=600)
+def get_fleet_units(end_date, district: str):
+    # there is no fleet master list, so the fleet is every unit that reported
+    # at least once in the lookback window
+    start_date = end_date - timedelta(days=FLEET_LOOKBACK_DAYS - 1)
+    with init_duckdb_connection(aws_creds, "4GB") as conn:
+        df = conn.sql(
+            f"""
+            SELECT DISTINCT unitno
+            FROM read_parquet('{COVERAGE_PATH}/**/*.parquet',hive_partitioning=true)
+            WHERE hiveperiod BETWEEN '{start_date}' AND '{end_date}'
+                AND dstrct_code = '{district}'
+            """
+        ).pl()
+
+    return df["unitno"].sort().to_list()
+
+
+def build_delivery_grid(
+    coverage: pl.DataFrame, units: list, start_date, end_date, now_wita: datetime
+):
+    # every fleet unit is expected to report every hour of every day in the
+    # window, hours with no coverage row at all count as zero delivery
+    units = pl.DataFrame({"unitno": units}, schema={"unitno": pl.String})
+    days = pl.date_range(start_date, end_date, "1d", eager=True).alias("hiveperiod")
+    hours = pl.DataFrame({"hour_wita": range(24)}, schema={"hour_wita": pl.Int64})
+
+    # today only counts hours that are over and already compacted, the latest
+    # hour with data is still filling up so it is left out as well
+    today = now_wita.date()
+    today_hours = coverage.filter(pl.col("hiveperiod").cast(pl.Date) == today)[
+        "hour_wita"
+    ]
+    today_cutoff = min(now_wita.hour, today_hours.max()) if len(today_hours) else 0
+
+    return (
+        units.join(days.to_frame(), how="cross")
+        .join(hours, how="cross")
+        .filter(
+            (pl.col("hiveperiod") < today)
+            | ((pl.col("hiveperiod") == today) & (pl.col("hour_wita") < today_cutoff))
+        )
+        .join(
+            coverage.select(
+                pl.col("hiveperiod").cast(pl.Date),
+                "unitno",
+                pl.col("hour_wita").cast(pl.Int64),
+                "received_seconds",
+            ),
+            on=["hiveperiod", "unitno", "hour_wita"],
+            how="left",
+        )
+        .with_columns(
+            pl.col("received_seconds").fill_null(0),
+            pl.lit(3600).alias("expected_seconds"),
+        )
+    )
+
+
+def build_unit_gaps(day_grid: pl.DataFrame, day_coverage: pl.DataFrame, unitno: str):
+    # gaps follow the same hours as the heatmap: an expected hour without a
+    # coverage row is a full-hour gap, and gaps touching across hour
+    # boundaries are joined into one outage
+    hours = (
+        day_grid.filter(pl.col("unitno") == unitno)
+        .select("hiveperiod", "unitno", "hour_wita")
+        .join(
+            day_coverage.select(
+                pl.col("hiveperiod").cast(pl.Date),
+                "unitno",
+                pl.col("hour_wita").cast(pl.Int64),
+                "gaps",
+            ),
+            on=["hiveperiod", "unitno", "hour_wita"],
+            how="left",
+        )
+    )
+    hour_start = pl.col("hiveperiod").cast(pl.Datetime("us")) + pl.duration(
+        hours=pl.col("hour_wita")
+    )
+
+    full_hour_gaps = hours.filter(pl.col("gaps").is_null()).select(
+        "unitno",
+        hour_start.alias("gap_start"),
+        (hour_start + pl.duration(hours=1)).alias("gap_end"),
+    )
+    partial_gaps = (
+        hours.filter(pl.col("gaps").is_not_null())
+        .select("unitno", "gaps")
+        .explode("gaps")
+        .drop_nulls("gaps")
+        .unnest("gaps")
+        .select(
+            "unitno",
+            pl.col("gap_start").cast(pl.Datetime("us")),
+            pl.col("gap_end").cast(pl.Datetime("us")),
+        )
+    )
+
+    return (
+        pl.concat([full_hour_gaps, partial_gaps])
+        .sort("gap_start")
+        .with_columns(
+            (pl.col("gap_start") != pl.col("gap_end").shift(1))
+            .fill_null(True)
+            .cum_sum()
+            .alias("gap_id")
+        )
+        .group_by("unitno", "gap_id")
+        .agg(pl.col("gap_start").min(), pl.col("gap_end").max())
+        .sort("gap_start")
+        .with_columns(
+            (pl.col("gap_end") - pl.col("gap_start"))
+            .dt.total_seconds()
+            .alias("gap_seconds")
+        )
+        .drop("gap_id")
+    )
+
+
 # ====== LAYOUT ======
 st.title("Smartd MH02 Business Intelligence")
-tab_deviation, tab_speed = st.tabs(["Deviation Analysis", "Speed Analysis"])
+tab_deviation, tab_speed, tab_delivery = st.tabs(
+    ["Deviation Analysis", "Speed Analysis", "Data Delivery"]
+)
 
 # ====== INIT SESSION STATE ======
 if "filter_button_pressed" not in st.session_state:
@@ -228,3 +370,105 @@ if st.session_state.filter_button_pressed:
                 x="datetime_wita",
                 y=["error_rate", "gpsnumsat"],
             )
+
+# coverage table is small, so the delivery tab renders without Apply Filter!
+with tab_delivery:
+    if hiveperiod is None:
+        st.text("Pick a hiveperiod to see data delivery")
+    else:
+        trend_start = hiveperiod - timedelta(days=DELIVERY_TREND_DAYS - 1)
+        coverage = None
+        fleet_units = []
+        try:
+            coverage = get_coverage(trend_start, hiveperiod, district)
+            fleet_units = get_fleet_units(hiveperiod, district)
+        except Exception as e:
+            st.text(f"Exception occured {e}")
+
+        if coverage is not None and len(fleet_units) > 0:
+            st.text(
+                f"Fleet: {len(fleet_units)} units that reported in the last "
+                f"{FLEET_LOOKBACK_DAYS} days, units dark for longer are not shown. "
+                "Today only counts completed, compacted hours."
+            )
+            delivery_grid = build_delivery_grid(
+                coverage, fleet_units, trend_start, hiveperiod, wita_today
+            )
+            day_grid = delivery_grid.filter(pl.col("hiveperiod") == hiveperiod)
+            day_coverage = coverage.filter(
+                pl.col("hiveperiod").cast(pl.Date) == hiveperiod
+            )
+
+            if len(day_coverage) == 0 or len(day_grid) == 0:
+                st.text(f"No coverage data for {district} on {hiveperiod}")
+            else:
+                fleet_rate = (
+                    day_grid["received_seconds"].sum()
+                    / day_grid["expected_seconds"].sum()
+                )
+                st.metric(
+                    f"Fleet data delivery on {hiveperiod}", f"{fleet_rate:.1%}"
+                )
+
+                hourly = (
+                    day_grid.with_columns(
+                        (
+                            pl.col("received_seconds") / pl.col("expected_seconds")
+                        ).alias("delivery_rate")
+                    )
+                    .sort("hour_wita")
+                    .pivot("hour_wita", index="unitno", values="delivery_rate")
+                    .sort("unitno")
+                )
+                st.plotly_chart(
+                    px.imshow(
+                        hourly.drop("unitno").to_numpy(),
+                        x=hourly.drop("unitno").columns,
+                        y=hourly["unitno"].to_list(),
+                        zmin=0,
+                        zmax=1,
+                        color_continuous_scale="RdYlGn",
+                        aspect="auto",
+                        labels={
+                            "x": "Hour (WITA)",
+                            "y": "Unitno",
+                            "color": "Delivery",
+                        },
+                        title=f"Hourly delivery rate on {hiveperiod}",
+                    )
+                )
+
+                unit_gaps = build_unit_gaps(day_grid, day_coverage, unitno)
+                st.text(f"Data gaps for {unitno} on {hiveperiod}")
+                st.dataframe(unit_gaps)
+
+            daily = (
+                delivery_grid.group_by("unitno", "hiveperiod")
+                .agg(
+                    (
+                        pl.col("received_seconds").sum()
+                        / pl.col("expected_seconds").sum()
+                    ).alias("delivery_rate")
+                )
+                .sort("hiveperiod")
+                .pivot("hiveperiod", index="unitno", values="delivery_rate")
+                .sort("unitno")
+            )
+            st.plotly_chart(
+                px.imshow(
+                    daily.drop("unitno").to_numpy(),
+                    x=daily.drop("unitno").columns,
+                    y=daily["unitno"].to_list(),
+                    zmin=0,
+                    zmax=1,
+                    color_continuous_scale="RdYlGn",
+                    aspect="auto",
+                    labels={"x": "Hiveperiod", "y": "Unitno", "color": "Delivery"},
+                    title=f"Daily delivery rate, last {DELIVERY_TREND_DAYS} days",
+                )
+            )
+        elif coverage is not None:
+            st.text(
+                f"No coverage data for {district} in the last "
+                f"{FLEET_LOOKBACK_DAYS} days up to {hiveperiod}"
+            )
@@ -30,6 +30,7 @@ with open(Path(CREDENTIALS_PATH), "r") as file:
 
 TARGET_BUCKET_PATH = "s3://smartdbucket/datalog/cis_smartd_tbl_iot_scania"
 # TARGET_BUCKET_PATH = "data"
+COVERAGE_BUCKET_PATH = "s3://smartdbucket/datalog/cis_smartd_tbl_iot_coverage"
 BUCKET_NAME = "smartdbucket"
 SOURCE_KEY_GLOB = "s3://smartdbucket/datalog"
 RAM_LIMIT = "10GB"
@@ -148,6 +149,7 @@ def init_duckdb_connection(aws_credentials: dict, ram_limit: str):
     try:
         logger.info("Initializing duckdb connection to S3")
         conn = duckdb.connect()
+        conn.execute("SET TimeZone = 'UTC';")
         conn.execute("INSTALL httpfs;")
         conn.execute("LOAD httpfs;")
         conn.execute(f"SET memory_limit = '{ram_limit}'")
@@ -209,8 +211,44 @@ def get_pending_keys_sql(engine, distrik, file_limit=1000):
     return list_of_keys
 
 
+def build_batch_coverage(conn, data_view: str, table_name: str):
+    """
+    Aggregate a batch of raw datalog into per unit-hour bitmaps of received
+    seconds, in the same pass that counts the batch rows.
+
+    conn(obj) = duckdb connection the batch view is registered on
+    data_view(str) = name of the registered batch datalog view
+    table_name(str) = name of the batch coverage temp table to create
+    """
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE {table_name} AS
+        SELECT
+            hiveperiod,
+            dstrct_code,
+            unitno,
+            hour(to_timestamp(heartbeat) + INTERVAL 8 HOURS) AS hour_wita,
+            bitstring_agg(
+                CAST(minute(to_timestamp(heartbeat)) * 60 + second(to_timestamp(heartbeat)) AS INTEGER),
+                0,
+                3599
+            ) AS received_bitmap,
+            count(*) AS row_count
+        FROM {data_view}
+        GROUP BY ALL
+    """
+    )
+
+    return None
+
+
 def get_datalog_from_s3_per_hiveperiod(
-    conn, bucket_name: str, s3key_list: list, targetpath: str, distrik: str
+    conn,
+    bucket_name: str,
+    s3key_list: list,
+    targetpath: str,
+    coverage_path: str,
+    distrik: str,
 ):
     logger = logging.getLogger(__name__)
 
@@ -231,15 +269,26 @@ def get_datalog_from_s3_per_hiveperiod(
     """
     )
 
+    conn.register("data", data)
+
     logger.info("Got the main data from s3")
 
-    row_count = data.count("*").fetchone()[0]
+    batch_coverage = "batch_coverage"
+    build_batch_coverage(conn, "data", batch_coverage)
+
+    row_count = (
+        conn.sql(f"SELECT sum(row_count) FROM {batch_coverage}").fetchone()[0] or 0
+    )
 
     if row_count == 0:
         logger.warning(f"No data found for {s3key_list_string}")
 
         return None
 
+    # coverage goes first: re-OR-ing a bitmap on retry is harmless, while a
+    # failure between the APPEND and the status update would duplicate rows
+    update_coverage_table(conn, batch_coverage, coverage_path, distrik)
+
     logger.info(f"Writing parquet file to target with {row_count} rows")
 
     main_query = f"""
@@ -265,6 +314,183 @@ def get_datalog_from_s3_per_hiveperiod(
     return None
 
 
+def update_coverage_table(conn, batch_coverage: str, coverage_path: str, distrik: str):
+    """
+    Merge a batch coverage table (see build_batch_coverage) into the coverage
+    table (expected vs received seconds per unit per WITA hour).
+
+    Received seconds are kept as a 3600 bit bitmap per unit-hour so late files
+    are merged with a bitwise OR instead of rescanning raw partitions. Only the
+    hiveperiod partitions touched by the batch are rewritten, and gaps are only
+    recomputed for the unit-hours the batch actually changed.
+
+    conn(obj) = duckdb connection holding the batch coverage temp table
+    batch_coverage(str) = name of the batch coverage temp table
+    coverage_path(str) = root path of the coverage table (s3://bucket/prefix)
+    distrik(str) = district code of the batch (BRCB or BRCG)
+    """
+    logger = logging.getLogger(__name__)
+
+    batch_rows = conn.sql(
+        f"SELECT count(*) FROM {batch_coverage} WHERE unitno IS NOT NULL AND hour_wita IS NOT NULL"
+    ).fetchone()[0]
+    if batch_rows == 0:
+        logger.info("No unit-hours in batch, coverage table untouched")
+        return None
+
+    logger.info(f"Merging {batch_rows} unit-hours into coverage table")
+
+    existing_files = [
+        row[0]
+        for row in conn.sql(
+            f"""
+            SELECT file
+            FROM glob('{coverage_path}/*/dstrct_code={distrik}/*.parquet')
+            WHERE regexp_extract(file, 'hiveperiod=([^/]+)', 1) IN (
+                SELECT DISTINCT CAST(hiveperiod AS VARCHAR) FROM {batch_coverage}
+            )
+        """
+        ).fetchall()
+    ]
+    logger.info(f"Found {len(existing_files)} existing coverage partitions to merge")
+
+    if existing_files:
+        existing_files_string = "['" + "', '".join(existing_files) + "']"
+        existing_source = f"""
+            SELECT
+                CAST(hiveperiod AS DATE) AS hiveperiod,
+                CAST(dstrct_code AS VARCHAR) AS dstrct_code,
+                unitno,
+                hour_wita,
+                expected_seconds,
+                received_seconds,
+                delivery_rate,
+                received_bitmap,
+                gaps,
+                updated_at
+            FROM read_parquet({existing_files_string}, hive_partitioning=true)
+        """
+    else:
+        existing_source = """
+            SELECT
+                NULL::DATE AS hiveperiod,
+                NULL::VARCHAR AS dstrct_code,
+                NULL::VARCHAR AS unitno,
+                NULL::BIGINT AS hour_wita,
+                NULL::INTEGER AS expected_seconds,
+                NULL::BIGINT AS received_seconds,
+                NULL::DOUBLE AS delivery_rate,
+                NULL::VARCHAR AS received_bitmap,
+                NULL::STRUCT(gap_start TIMESTAMP, gap_end TIMESTAMP, gap_seconds BIGINT)[] AS gaps,
+                NULL::TIMESTAMP AS updated_at
+            WHERE false
+        """
+
+    conn.execute(f"CREATE OR REPLACE TEMP TABLE existing_coverage AS {existing_source}")
+
+    try:
+        conn.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE merged_coverage AS
+            WITH changed AS (
+                SELECT hiveperiod, dstrct_code, unitno, hour_wita, bit_or(received_bitmap) AS received_bitmap
+                FROM (
+                    SELECT hiveperiod, dstrct_code, unitno, hour_wita, received_bitmap
+                    FROM {batch_coverage}
+                    WHERE unitno IS NOT NULL AND hour_wita IS NOT NULL
+                    UNION ALL
+                    SELECT e.hiveperiod, e.dstrct_code, e.unitno, e.hour_wita, CAST(e.received_bitmap AS BIT)
+                    FROM existing_coverage e
+                    SEMI JOIN {batch_coverage} b USING (hiveperiod, dstrct_code, unitno, hour_wita)
+                )
+                GROUP BY ALL
+            ),
+            -- split each bitmap into runs of 0s and 1s instead of expanding every
+            -- unit-hour into 3600 rows, runs of 0s are the gaps
+            bitmap_runs AS (
+                SELECT
+                    hiveperiod, dstrct_code, unitno, hour_wita,
+                    unnest(runs) AS run,
+                    generate_subscripts(runs, 1) AS run_index
+                FROM (
+                    SELECT *, regexp_extract_all(CAST(received_bitmap AS VARCHAR), '0+|1+') AS runs
+                    FROM changed
+                )
+            ),
+            gap_intervals AS (
+                SELECT
+                    hiveperiod, dstrct_code, unitno, hour_wita,
+                    first_second,
+                    first_second + length(run) AS end_second
+                FROM (
+                    SELECT
+                        *,
+                        CAST(
+                            sum(length(run)) OVER (
+                                PARTITION BY hiveperiod, dstrct_code, unitno, hour_wita ORDER BY run_index
+                            ) - length(run) AS BIGINT
+                        ) AS first_second
+                    FROM bitmap_runs
+                )
+                WHERE starts_with(run, '0')
+            ),
+            gaps AS (
+                SELECT
+                    hiveperiod, dstrct_code, unitno, hour_wita,
+                    list(
+                        {{
+                            'gap_start': hiveperiod + to_hours(hour_wita) + to_seconds(first_second),
+                            'gap_end': hiveperiod + to_hours(hour_wita) + to_seconds(end_second),
+                            'gap_seconds': end_second - first_second
+                        }}
+                        ORDER BY first_second
+                    ) AS gaps
+                FROM gap_intervals
+                GROUP BY ALL
+            )
+            SELECT
+                c.hiveperiod,
+                c.dstrct_code,
+                c.unitno,
+                c.hour_wita,
+                3600 AS expected_seconds,
+                bit_count(c.received_bitmap) AS received_seconds,
+                bit_count(c.received_bitmap) / 3600 AS delivery_rate,
+                CAST(c.received_bitmap AS VARCHAR) AS received_bitmap,
+                coalesce(g.gaps, []) AS gaps,
+                CAST(now() AS TIMESTAMP) AS updated_at
+            FROM changed c
+            LEFT JOIN gaps g USING (hiveperiod, dstrct_code, unitno, hour_wita)
+            UNION ALL
+            SELECT e.*
+            FROM existing_coverage e
+            ANTI JOIN {batch_coverage} b USING (hiveperiod, dstrct_code, unitno, hour_wita)
+        """
+        )
+
+        # partitions are rewritten whole, so a fixed file name replaces the old one
+        conn.execute(
+            f"""
+            COPY (SELECT * FROM merged_coverage ORDER BY unitno, hour_wita)
+            TO '{coverage_path}'
+            (
+                FORMAT parquet,
+                COMPRESSION snappy,
+                PARTITION_BY (hiveperiod, dstrct_code),
+                FILENAME_PATTERN 'coverage',
+                OVERWRITE_OR_IGNORE
+            )
+        """
+        )
+    except Exception:
+        logger.exception("Coverage table merge failed!")
+        raise
+
+    logger.info("Coverage table updated")
+
+    return None
+
+
 def update_compression_status_in_db(engine, keys: list, distrik: str):
     logger = logging.getLogger(__name__)
     row_num = len(keys)
@@ -313,7 +539,7 @@ def main():
 
     with init_duckdb_connection(aws_creds, RAM_LIMIT) as conn:
         get_datalog_from_s3_per_hiveperiod(
-            conn, BUCKET_NAME, keys, TARGET_BUCKET_PATH, DISTRIK
+            conn, BUCKET_NAME, keys, TARGET_BUCKET_PATH, COVERAGE_BUCKET_PATH, DISTRIK
         )
     result = update_compression_status_in_db(engine, keys, DISTRIK)
 